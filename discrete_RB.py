@@ -7,6 +7,10 @@ along with a few helper functions
 
 import numpy as np
 import cvxpy as cp
+try:
+    import numba
+except ImportError:
+    numba = None  # numba is optional, the samplers fall back to vectorized numpy without it
 
 
 class RB(object):
@@ -17,24 +21,26 @@ class RB(object):
     :param reward_tensor: np array of shape (S,a), representing the reward function {r(s,a)}
     :param N: number of arms
     :param init_states: the initial states of the arms. Initialize all arms to state 0 if not provided
+    :param seed: the seed of the random number generator. Drawn from the global state of np.random if not provided
     """
-    def __init__(self, sspa_size, trans_tensor, reward_tensor, N, init_states=None):
+    def __init__(self, sspa_size, trans_tensor, reward_tensor, N, init_states=None, seed=None):
         self.sspa_size = sspa_size
         self.sspa = np.array(list(range(self.sspa_size)))
         self.aspa_size = 2
         self.aspa = np.array(list(range(self.aspa_size)))
-        self.sa_pairs = []
-        for action in self.aspa:
-            self.sa_pairs = self.sa_pairs + [(state, action) for state in self.sspa]
         self.N = N
-        # map of state action to next states
-        self.trans_dict = {sa_pair: trans_tensor[sa_pair[0], sa_pair[1], :] for sa_pair in self.sa_pairs}
-        self.reward_dict = {sa_pair: reward_tensor[sa_pair[0], sa_pair[1]] for sa_pair in self.sa_pairs}
+        self.trans_tensor = trans_tensor
+        self.reward_tensor = reward_tensor
+        # transition kernel and its cumulative sums with (state, action) flattened into row state * A + action
+        self.flat_trans = np.ascontiguousarray(trans_tensor.reshape((self.sspa_size * self.aspa_size, self.sspa_size)))
+        self.flat_cum_trans = np.cumsum(self.flat_trans, axis=1)
+        self._rng = make_rng(seed)
         # initialize the state of the arms at 0
+        self.state_dtype = get_state_dtype(self.sspa_size)
         if init_states is not None:
-            self.states = init_states.copy()
+            self.states = np.asarray(init_states).astype(self.state_dtype)
         else:
-            self.states = np.zeros((self.N,))
+            self.states = np.zeros((self.N,), dtype=self.state_dtype)
 
     def get_states(self):
         return self.states.copy()
@@ -44,30 +50,20 @@ class RB(object):
         :param actions: a 1-d array with length N. Each entry is 0 or 1, denoting the action of each arm
         :return: intantaneous reward of the this time step
         """
-        sa2indices = {sa_pair:None for sa_pair in self.sa_pairs} # each key is a list of indices in the range of self.N
-        # find out the arms whose (state, action) = sa_pair
-        for sa_pair in self.sa_pairs:
-            sa2indices[sa_pair] = np.where(np.all([self.states == sa_pair[0], actions == sa_pair[1]], axis=0))[0]
-        instant_reward = 0
-        for sa_pair in self.sa_pairs:
-            next_states = np.random.choice(self.sspa, len(sa2indices[sa_pair]), p=self.trans_dict[sa_pair])
-            self.states[sa2indices[sa_pair]] = next_states
-            instant_reward += self.reward_dict[sa_pair] * len(sa2indices[sa_pair])
+        actions = np.asarray(actions, dtype=np.int8)
+        instant_reward = float(self.reward_tensor[self.states, actions].sum())
+        u = self._rng.random(self.N)
+        sample_next_states(self.states, actions, self.flat_cum_trans, u, out=self.states)
         instant_reward = instant_reward / self.N  # we normalize it by the number of arms
         return instant_reward
 
     def get_s_counts(self):
-        s_counts = np.zeros(self.sspa_size)
-        # find out the arms whose (state, action) = sa_pair
-        for state in self.sspa:
-            s_counts[state] = len(np.where([self.states == state])[0])
+        # count the number of arms in each state
+        s_counts = np.bincount(self.states, minlength=self.sspa_size).astype(np.float64)
         return s_counts
 
     def get_s_fracs(self):
-        s_counts = self.get_s_counts()
-        s_fracs = np.zeros(self.sspa_size)
-        for state in self.sspa:
-            s_fracs[state] = s_counts[state] / self.N
+        s_fracs = self.get_s_counts() / self.N
         return s_fracs
 
 
@@ -84,12 +80,12 @@ class MeanFieldRB(object):
         self.sspa = np.array(list(range(self.sspa_size)))
         self.aspa_size = 2
         self.aspa = np.array(list(range(self.aspa_size)))
-        self.sa_pairs = []
-        for action in self.aspa:
-            self.sa_pairs = self.sa_pairs + [(state, action) for state in self.sspa]
         self.trans_tensor = trans_tensor
         self.reward_tensor = reward_tensor
+        # transition kernel with (state, action) flattened into row state * A + action
+        self.flat_trans = np.ascontiguousarray(trans_tensor.reshape((self.sspa_size * self.aspa_size, self.sspa_size)))
         self.EPS = 1e-7  # numbers smaller than this are regard as zero
+        self._debug_checks = False  # set to True to check the consistency of the fractions in each step
 
         # states are represented by the distribution of the arms
         if init_state_fracs is None:
@@ -103,15 +99,15 @@ class MeanFieldRB(object):
         :param sa_pair_fracs:
         :return: intantaneous reward of the this time step
         """
-        assert np.all(np.isclose(np.sum(sa_pair_fracs, axis=1), self.state_fracs, atol=1e-4)), \
-            "the input sa_pair_fracs is not consistent with current state, {}!={}".format(np.sum(sa_pair_fracs, axis=1), self.state_fracs)
-        new_state_fracs = np.zeros((self.sspa_size))
-        instant_reward = 0
-        for new_state in self.sspa:
-            new_state_fracs[new_state] = np.sum(sa_pair_fracs * self.trans_tensor[:,:,new_state])
+        if __debug__ and self._debug_checks:
+            assert np.all(np.isclose(np.sum(sa_pair_fracs, axis=1), self.state_fracs, atol=1e-4)), \
+                "the input sa_pair_fracs is not consistent with current state, {}!={}".format(np.sum(sa_pair_fracs, axis=1), self.state_fracs)
+        # new_state_fracs[s'] = sum_{s,a} sa_pair_fracs[s,a] * P(s,a,s')
+        new_state_fracs = np.reshape(sa_pair_fracs, (-1,)) @ self.flat_trans
         #print(sa_pair_fracs * self.reward_tensor)
-        instant_reward += np.sum(sa_pair_fracs * self.reward_tensor)
-        assert np.isclose(np.sum(new_state_fracs), 1.0, atol=1e-4), "new state fractions do not sum to one, the number we get is {}".format(np.sum(new_state_fracs))
+        instant_reward = np.sum(sa_pair_fracs * self.reward_tensor)
+        if __debug__ and self._debug_checks:
+            assert np.isclose(np.sum(new_state_fracs), 1.0, atol=1e-4), "new state fractions do not sum to one, the number we get is {}".format(np.sum(new_state_fracs))
         self.state_fracs = new_state_fracs
         return instant_reward
 
@@ -126,19 +122,18 @@ class SingleArmAnalyzer(object):
     :param trans_tensor: np array of shape (S,A,S), representing the transition kernel {P(s,a,s')}
     :param reward_tensor: np array of shape (S,a), representing the reward function {r(s,a)}
     :param act_frac: the fraction of arms to activate in each time slot
+    :param solver: the solver that cvxpy calls for the LPs. "HIGHS" by default; None lets cvxpy choose its default solver
     """
-    def __init__(self, sspa_size, trans_tensor, reward_tensor, act_frac):
+    def __init__(self, sspa_size, trans_tensor, reward_tensor, act_frac, solver="HIGHS"):
         # problem parameters
         self.sspa_size = sspa_size   # state-space size
         self.sspa = np.array(list(range(self.sspa_size)))  # state space
         self.aspa_size = 2   # action-space size
         self.aspa = np.array(list(range(self.aspa_size)))  # action space
-        self.sa_pairs = []   # all possible combinations of (state,action), defined for the convenience of iteration
-        for action in self.aspa:
-            self.sa_pairs = self.sa_pairs + [(state, action) for state in self.sspa]
         self.trans_tensor = trans_tensor
         self.reward_tensor = reward_tensor
         self.act_frac = act_frac
+        self.solver = solver
         # some constants
         self.EPS = 1e-7  # any numbers smaller than this are regard as zero
         min_reward = np.min(self.reward_tensor)
@@ -146,6 +141,7 @@ class SingleArmAnalyzer(object):
         self.DUALSTEP = 0.05 # the discretization step size of dual variable when solving for Whittle's index
         self.MINSUBSIDY = - (max_reward - min_reward) - self.DUALSTEP # a lower bound on the set of possible subsidies
         self.MAXSUBSIDY = (max_reward - min_reward) + self.DUALSTEP  # an upper bound on the set of possible subsidies
+        self.MAXITER = 10000  # the maximum number of iterations of relative value iteration
 
         # variables
         self.y = cp.Variable((self.sspa_size, 2))
@@ -160,10 +156,10 @@ class SingleArmAnalyzer(object):
         self.q_func_relaxed = np.zeros((self.sspa_size, 2))
 
     def get_stationary_constraints(self):
+        # a single vector constraint for all the states: sum_{s,a} y(s,a) P(s,a,s') = sum_a y(s',a) for each s'
         stationary_constrs = []
-        for cur_s in self.sspa:
-            m_s = cp.sum(cp.multiply(self.y, self.trans_tensor[:,:,cur_s]))
-            stationary_constrs.append(m_s == cp.sum(self.y[cur_s, :]))
+        m = sum(self.trans_tensor[:, action, :].T @ self.y[:, action] for action in self.aspa)
+        stationary_constrs.append(m == cp.sum(self.y, axis=1))
         return stationary_constrs
 
     def get_budget_constraints(self):
@@ -194,7 +190,7 @@ class SingleArmAnalyzer(object):
         objective = self.get_objective()
         constrs = self.get_stationary_constraints() + self.get_budget_constraints() + self.get_basic_constraints()
         problem = cp.Problem(objective, constrs)
-        self.opt_value = problem.solve()
+        self.opt_value = problem.solve(solver=self.solver)
         print("--------LP solved, solution as below-------")
         print("Optimal value ", self.opt_value)
         print("Optimal var")
@@ -211,17 +207,16 @@ class SingleArmAnalyzer(object):
             objective = self.get_relaxed_objective()
             constrs = self.get_stationary_constraints() + self.get_basic_constraints()
         problem = cp.Problem(objective, constrs)
-        self.opt_value = problem.solve(verbose=False)
+        self.opt_value = problem.solve(solver=self.solver, verbose=False)
 
         # get value function from the dual variables. Later we should rewrite the dual problem explicitly
         # average reward is the dual variable of "sum to 1" constraint
         self.avg_reward = constrs[-1].dual_value     # the sign is positive, DO NOT CHANGE IT
-        for i in range(self.sspa_size):
-            # value function is the dual of stationary constraint
-            self.value_func_relaxed[i] = - constrs[i].dual_value   # the sign is negative, DO NOT CHANGE IT
+        # value function is the dual of stationary constraint
+        self.value_func_relaxed = - np.asarray(constrs[0].dual_value)   # the sign is negative, DO NOT CHANGE IT
         if fixed_dual is None:
             # optimal subsidy for passive actions is the dual of budget constraint
-            self.opt_subsidy = constrs[self.sspa_size].dual_value
+            self.opt_subsidy = constrs[1].dual_value
         else:
             self.opt_subsidy = fixed_dual
 
@@ -238,19 +233,52 @@ class SingleArmAnalyzer(object):
         priority_list = np.flip(np.argsort(self.q_func_relaxed[:,1] - self.q_func_relaxed[:,0]))
         return list(priority_list)
 
-    def solve_whittles_policy(self):
-        # solve a set of relaxed problem with different subsidy values, and find out the Whittle's index
-        relaxed_objective = self.get_relaxed_objective()
-        constrs = self.get_stationary_constraints() + self.get_basic_constraints()
-        problem = cp.Problem(relaxed_objective, constrs)
+    def solve_relaxed_closed_form(self, subsidy):
+        """
+        solve the relaxed problem with a given subsidy by relative value iteration, without calling the LP solver.
+        The iteration runs on the kernel 0.5 * (P + I), which is aperiodic and has the same optimal actions.
+        :param subsidy: the subsidy for taking the passive action
+        :return: the relative q function, np array of shape (S,2); only the differences along actions are meaningful
+        """
+        subsidy_reward = self.reward_tensor.copy()
+        subsidy_reward[:, 0] += subsidy
+        aperiodic_trans = 0.5 * (self.trans_tensor + np.eye(self.sspa_size)[:, None, :])
+        value_func = np.zeros((self.sspa_size,))
+        for _ in range(self.MAXITER):
+            q_func = subsidy_reward + aperiodic_trans @ value_func
+            new_value_func = np.max(q_func, axis=1)
+            diff = new_value_func - value_func
+            value_func = new_value_func - new_value_func[0]  # state 0 is the reference state
+            if np.max(diff) - np.min(diff) < self.EPS:
+                break
+        else:
+            print("Warning: relative value iteration did not converge in {} iterations".format(self.MAXITER))
+        return q_func
+
+    def solve_whittles_policy(self, method="rvi"):
+        """
+        solve a set of relaxed problem with different subsidy values, and find out the Whittle's index
+        :param method: "rvi" solves each relaxed problem by relative value iteration; "lp" solves it as an LP with cvxpy
+        :return: priority_list, indexable
+        """
         subsidy_values = np.arange(self.MINSUBSIDY, self.MAXSUBSIDY, self.DUALSTEP)
         passive_table = np.zeros((self.sspa_size, len(subsidy_values))) # each row is a state, each column is a dual value
-        for i, subsidy in enumerate(subsidy_values):
-            self.dualvar.value = subsidy
-            problem.solve()
-            for state in self.sspa:
-                if (self.y.value[state, 0] > self.EPS) and (self.y.value[state, 1] < self.EPS):
-                    passive_table[state, i] = 1
+        if method == "rvi":
+            for i, subsidy in enumerate(subsidy_values):
+                q_func = self.solve_relaxed_closed_form(subsidy)
+                passive_table[:, i] = q_func[:, 0] >= q_func[:, 1]
+        elif method == "lp":
+            relaxed_objective = self.get_relaxed_objective()
+            constrs = self.get_stationary_constraints() + self.get_basic_constraints()
+            # the subsidy only enters through the parameter self.dualvar, so the problem is DPP:
+            # it is canonicalized once and then re-solved with warm start for each subsidy value
+            problem = cp.Problem(relaxed_objective, constrs)
+            for i, subsidy in enumerate(subsidy_values):
+                self.dualvar.value = subsidy
+                problem.solve(solver=self.solver, warm_start=True)
+                passive_table[:, i] = (self.y.value[:, 0] > self.EPS) & (self.y.value[:, 1] < self.EPS)
+        else:
+            raise ValueError("method should be 'rvi' or 'lp', got {}".format(method))
         wi2state = {}
         for state in self.sspa:
             approx_wi = np.where(passive_table[state, :])[0][0]  # find the smallest subsidy such that state becomes passive
@@ -270,63 +298,61 @@ class SingleArmAnalyzer(object):
 
 
 class PriorityPolicy(object):
-    def __init__(self, sspa_size, priority_list, N, act_frac):
+    def __init__(self, sspa_size, priority_list, N, act_frac, seed=None):
         """
         The policy that uses a certain priority to allocate budget
         :param sspa_size: size of the state space S
         :param priority_list: a list of states represented by numbers, from high priority to low priority
         :param N: number of arms
         :param act_frac: the fraction of arms to activate in each time slot
+        :param seed: the seed of the random number generator. Drawn from the global state of np.random if not provided
         """
         self.sspa_size = sspa_size
         self.sspa = np.array(list(range(self.sspa_size)))
         self.priority_list = priority_list
         self.act_frac = act_frac
         self.N = N
+        self.prio_rank = get_priority_ranks(self.sspa_size, self.priority_list)
+        self._prio_order = np.asarray(self.priority_list, dtype=np.intp)
+        self._debug_checks = False  # set to True to check that get_sa_pair_fracs uses up the budget
+        self._rng = make_rng(seed)
 
     def get_actions(self, cur_states):
         """
-        :param cur_states: the current states of the arms
+        :param cur_states: integer array of length N, the current states of the arms
         :return: the actions taken by the arms under the policy
         """
         # return actions from states
-        s2indices = {state:None for state in self.sspa} # each key is a list of indices in the range of self.N
-        # find out the arms whose (state, action) = sa_pair
-        for state in self.sspa:
-            s2indices[state] = np.where(cur_states == state)[0]
-
-        actions = np.zeros((self.N,))
-        rem_budget = int(self.N * self.act_frac)
-        rem_budget += np.random.binomial(1, self.N * self.act_frac - rem_budget)  # randomized rounding
-        # go from high priority to low priority
-        for state in self.priority_list:
-            num_arms_this_state = len(s2indices[state])
-            if rem_budget >= num_arms_this_state:
-                actions[s2indices[state]] = 1
-                rem_budget -= num_arms_this_state
-            else:
-                # break ties uniformly, sample without replacement
-                chosen_indices = np.random.choice(s2indices[state], size=rem_budget, replace=False)
-                actions[chosen_indices] = 1
-                rem_budget = 0
-                break
+        # sort the arms by the ranks of their states; the arms of rank k are order[boundaries[k]:boundaries[k+1]],
+        # so the arms ranked above k are order[:boundaries[k]]
+        ranks = self.prio_rank[cur_states]
+        order, boundaries = group_by_state(ranks, len(self.priority_list))
+
+        actions = np.zeros((self.N,), dtype=np.int8)
+        rem_budget = randomized_rounding(self.N * self.act_frac, self._rng)
+        # activate all the arms in the highest-priority states that fit into the budget
+        num_full_ranks = np.searchsorted(boundaries, rem_budget, side="right") - 1
+        actions[order[:boundaries[num_full_ranks]]] = 1
+        rem_budget -= boundaries[num_full_ranks]
+        if (rem_budget > 0) and (num_full_ranks < len(self.priority_list)):
+            # break ties uniformly in the next state, sample without replacement
+            indices_this_state = order[boundaries[num_full_ranks]:boundaries[num_full_ranks+1]]
+            chosen_indices = self._rng.choice(indices_this_state, size=rem_budget, replace=False, shuffle=False)
+            actions[chosen_indices] = 1
+            rem_budget = 0
         assert rem_budget == 0, "something is wrong, whittles index should use up all the budget"
         return actions
 
     def get_sa_pair_fracs(self, cur_state_fracs):
         sa_pair_fracs = np.zeros((self.sspa_size, 2))
-        rem_budget_normalize = self.act_frac
-        for state in self.priority_list:
-            frac_arms_this_state = cur_state_fracs[state]
-            if rem_budget_normalize >= frac_arms_this_state:
-                sa_pair_fracs[state, 1] = frac_arms_this_state
-                sa_pair_fracs[state, 0] = 0.0
-                rem_budget_normalize -= frac_arms_this_state
-            else:
-                sa_pair_fracs[state, 1] = rem_budget_normalize
-                sa_pair_fracs[state, 0] = frac_arms_this_state - rem_budget_normalize
-                rem_budget_normalize = 0
-        assert rem_budget_normalize == 0.0, "something is wrong, whittles index should use up all the budget"
+        # going from high priority to low priority, each state gets the budget left by the states before it
+        ordered_fracs = cur_state_fracs[self._prio_order]
+        rem_budget_normalize = self.act_frac - (np.cumsum(ordered_fracs) - ordered_fracs)
+        active_fracs = np.clip(rem_budget_normalize, 0.0, ordered_fracs)
+        sa_pair_fracs[self._prio_order, 1] = active_fracs
+        sa_pair_fracs[self._prio_order, 0] = ordered_fracs - active_fracs
+        if __debug__ and self._debug_checks:
+            assert np.isclose(np.sum(active_fracs), self.act_frac), "something is wrong, whittles index should use up all the budget"
         return sa_pair_fracs
 
 
@@ -337,19 +363,18 @@ class RandomTBPolicy(object):
     :param y: a solution of the single-armed problem
     :param N: number of arms
     :param act_frac: the fraction of arms to activate in each time slot
+    :param seed: the seed of the random number generator. Drawn from the global state of np.random if not provided
     """
-    def __init__(self, sspa_size, y, N, act_frac):
+    def __init__(self, sspa_size, y, N, act_frac, seed=None):
         self.sspa_size = sspa_size
         self.sspa = np.array(list(range(self.sspa_size)))
         self.aspa = np.array([0, 1])
-        self.sa_pairs = []
-        for action in self.aspa:
-            self.sa_pairs = self.sa_pairs + [(state, action) for state in self.sspa]
 
         self.N = N
         self.act_frac = act_frac
         self.y = y
         self.EPS = 1e-7
+        self._rng = make_rng(seed)
 
         # get the randomized policy from the solution y
         self.state_probs = np.sum(self.y, axis=1)
@@ -365,28 +390,16 @@ class RandomTBPolicy(object):
 
     def get_actions(self, cur_states):
         """
-        :param cur_states: the current states of the arms
+        :param cur_states: integer array of length N, the current states of the arms
         :return: the actions taken by the arms under the policy
         """
-        s2indices = {state:None for state in self.sspa}
-        # count the indices of arms in each state
-        for state in self.sspa:
-            s2indices[state] = np.where(cur_states == state)[0]
-        actions = np.zeros((self.N,), dtype=np.int64)
-        for state in self.sspa:
-            actions[s2indices[state]] = np.random.choice(self.aspa, size=len(s2indices[state]), p=self.policy[state])
-
-        budget = int(self.N * self.act_frac)
-        budget += np.random.binomial(1, self.N * self.act_frac - budget)  # randomized rounding
-        num_requests = np.sum(actions)
-        if num_requests > budget:
-            indices_request = np.where(actions==1)[0]
-            request_ignored = np.random.choice(indices_request, int(num_requests - budget), replace=False)
-            actions[request_ignored] = 0
-        else:
-            indices_no_request = np.where(actions==0)[0]
-            no_request_pulled = np.random.choice(indices_no_request, int(budget - num_requests), replace=False)
-            actions[no_request_pulled] = 1
+        # each arm requests activation with the probability given by the policy in its current state
+        actions = (self._rng.random(self.N) < self.policy[cur_states, 1]).astype(np.int8)
+
+        budget = randomized_rounding(self.N * self.act_frac, self._rng)
+        # activate exactly budget arms: requests are served first, and ties are broken by the uniform noise,
+        # which is the same as ignoring random requests or pulling random non-requesting arms
+        actions = select_top_k(actions + self._rng.random(self.N), budget)
 
         return actions
 
@@ -402,26 +415,32 @@ class FTVAPolicy(object):
     :param N: number of arms
     :param act_frac: the fraction of arms to activate in each time slot
     :param init_virtual: initial virtual states of the arms; initialized uniformly at random if not provided
+    :param seed: the seed of the random number generator. Drawn from the global state of np.random if not provided
     """
-    def __init__(self, sspa_size, trans_tensor, reward_tensor, y, N, act_frac, init_virtual):
+    def __init__(self, sspa_size, trans_tensor, reward_tensor, y, N, act_frac, init_virtual, seed=None):
         self.sspa_size = sspa_size
         self.sspa = np.array(list(range(self.sspa_size)))
         self.aspa = np.array([0, 1])
-        self.sa_pairs = []
-        for action in self.aspa:
-            self.sa_pairs = self.sa_pairs + [(state, action) for state in self.sspa]
 
         self.trans_tensor = trans_tensor
         self.reward_tensor = reward_tensor
+        # transition kernel and its cumulative sums with (state, action) flattened into row state * A + action
+        self.flat_trans = np.ascontiguousarray(trans_tensor.reshape((self.sspa_size * len(self.aspa), self.sspa_size)))
+        self.flat_cum_trans = np.cumsum(self.flat_trans, axis=1)
         self.N = N
         self.act_frac = act_frac
         self.y = y
         self.EPS = 1e-7
+        self._rng = make_rng(seed)
+        # the priority levels of the "goodness" tie-breaking rule, indexed by 2 * is_good_arm + virtual_action:
+        # request+good (0) > request+bad (1) > no_req+bad (2) > no_req+good (3)
+        self.goodness_levels = np.array([2, 1, 3, 0], dtype=np.intp)
 
+        self.state_dtype = get_state_dtype(self.sspa_size)
         if init_virtual is None:
-            self.virtual_states = np.random.choice(self.sspa, self.N)
+            self.virtual_states = self._rng.integers(0, self.sspa_size, size=self.N).astype(self.state_dtype)
         else:
-            self.virtual_states = init_virtual.copy()
+            self.virtual_states = np.asarray(init_virtual).astype(self.state_dtype)
 
         # get the randomized policy from the solution y
         self.state_probs = np.sum(self.y, axis=1)
@@ -437,107 +456,50 @@ class FTVAPolicy(object):
 
     def get_actions(self, cur_states, tb_rule=None, tb_param=None):
         """
-        :param cur_states: current state, actually not needed
+        :param cur_states: integer array of length N, the current states of the arms
         :param tb_rule: a string, "goodness" "naive" "priority" or "goodness-priority". By default it is "goodness"
         :param tb_param: parameter of the tie-breaking policy. Only needed if tb_rule = "priority" or "goodness-priority".
         :return: actions, virtual_actions
         """
         # generate budget using randomized rounding
-        budget = int(self.N * self.act_frac)
-        budget += np.random.binomial(1, self.N * self.act_frac - budget)  # randomized rounding
-        # generate virtual actions according to virtual states
-        vs2indices = {state:None for state in self.sspa}
-        # find the indices of arms that are in each virtual state
-        for state in self.sspa:
-            vs2indices[state] = np.where(self.virtual_states == state)[0]
-        # generate virtual actions using the policy
-        virtual_actions = np.zeros((self.N,), dtype=np.int64)
-        for state in self.sspa:
-            virtual_actions[vs2indices[state]] = np.random.choice(self.aspa, size=len(vs2indices[state]), p=self.policy[state])
+        budget = randomized_rounding(self.N * self.act_frac, self._rng)
+        # generate virtual actions according to virtual states, using the policy
+        virtual_actions = (self._rng.random(self.N) < self.policy[self.virtual_states, 1]).astype(np.int8)
 
         # Below we modify virtual actions into real actions, so that they satisfy the budget constraint
         # several different tie breaking rules
+        # each rule assigns a priority level to each arm, where smaller levels are activated first;
+        # the uniform noise added to the levels breaks ties uniformly at random within a level
         if (tb_rule is None) or (tb_rule == "goodness"):
             # method 1 (the default option): we prioritize maintaining "good arms"
             # then essentially four priority levels:
             # request+good, request+bad, no_req +bad, no_req +good
-            actions = np.zeros((self.N,))
-            good_arm_mask = cur_states == self.virtual_states
-            priority_levels = [virtual_actions * good_arm_mask, virtual_actions * (1-good_arm_mask),
-                                (1-virtual_actions)*(1-good_arm_mask), (1-virtual_actions)*good_arm_mask]
-            rem_budget = budget
-            for i in range(len(priority_levels)):
-                level_i_indices = np.where(priority_levels[i])[0] # find the indices of the arms whose priority is in level i.
-                if rem_budget >= len(level_i_indices):
-                    actions[level_i_indices] = 1
-                    rem_budget -= len(level_i_indices)
-                else:
-                    activate_indices = np.random.choice(level_i_indices, rem_budget, replace=False)
-                    actions[activate_indices] = 1
-                    rem_budget = 0
-                    break
+            good_arm_mask = (cur_states == self.virtual_states).astype(np.int8)
+            priority_levels = self.goodness_levels[2 * good_arm_mask + virtual_actions]
+            actions = select_top_k(- (priority_levels + self._rng.random(self.N)), budget)
         elif tb_rule == "naive":
             ### (IMPORTANT) Here we can have different ways of select arms to respond to
             # method 2: we randomly choose arms and flip their actions
-            actions = virtual_actions.copy()
-            num_requests = np.sum(actions)
-            if num_requests > budget:
-                indices_request = np.where(virtual_actions==1)[0]
-                request_ignored = np.random.choice(indices_request, int(num_requests - budget), replace=False)
-                actions[request_ignored] = 0
-            else:
-                indices_no_request = np.where(actions==0)[0]
-                no_request_pulled = np.random.choice(indices_no_request, int(budget - num_requests), replace=False)
-                actions[no_request_pulled] = 1
+            actions = select_top_k(virtual_actions + self._rng.random(self.N), budget)
         elif tb_rule == "priority":
             # tie-breaking based on priority of the virtual states.
             # specifically, first break into two large classes based on virtual actions
             # then within each large class, break into smaller classes using the priority
             # this should be equivalent to tie-breaking using pure priority as long as there is only one neutral state
             assert type(tb_param) == list, "tb_param should be priority list, sorted from high priority states to low priority states"
-            actions = np.zeros((self.N,))
             # divide into two rough classe using virtual actions. Arms with virtual action = 1 has higher priority than those with virtual action = 0
-            priority_rough_classes = [virtual_actions, 1-virtual_actions]
-            priority_levels = []
-            for rough_class in priority_rough_classes:
-                for i in range(len(tb_param)):
-                    priority_levels.append(np.where(rough_class * (self.virtual_states == tb_param[i]))[0])
-            # assign budget along the priority levels
-            rem_budget = budget
-            for i in range(len(priority_levels)):
-                # selecting arms whose virtual states rank i in the priority list
-                level_i_indices = priority_levels[i]
-                if rem_budget >= len(level_i_indices):
-                    actions[level_i_indices] = 1
-                    rem_budget -= len(level_i_indices)
-                else:
-                    activate_indices = np.random.choice(level_i_indices, rem_budget, replace=False)
-                    actions[activate_indices] = 1
-                    rem_budget = 0
-                    break
+            tb_ranks = get_priority_ranks(self.sspa_size, tb_param)
+            priority_levels = (1 - virtual_actions.astype(np.intp)) * (len(tb_param) + 1) + tb_ranks[self.virtual_states]
+            actions = select_top_k(- (priority_levels + self._rng.random(self.N)), budget)
         elif tb_rule == "goodness-priority":
             # tie-breaking based on the goodness of arms, and the priority of virtual states.
             # good + fluid_active > bad + fluid_active > bad + fluid_passive > good + fluid_passive
             assert type(tb_param) == list, "tb_param should be priority list, sorted from high priorities to low priorities"
-            actions = np.zeros((self.N,))
-            good_arm_mask = cur_states == self.virtual_states
-            priority_rough_classes = [virtual_actions * good_arm_mask, virtual_actions * (1-good_arm_mask),
-                                (1-virtual_actions)*(1-good_arm_mask), (1-virtual_actions)*good_arm_mask]
-            priority_levels = []
-            for rough_class in priority_rough_classes:
-                for i in range(len(tb_param)):
-                    priority_levels.append(np.where(rough_class * (self.virtual_states == tb_param[i]))[0])
-            rem_budget = budget
-            for i in range(len(priority_levels)):
-                level_i_indices = priority_levels[i]
-                if rem_budget >= len(level_i_indices):
-                    actions[level_i_indices] = 1
-                    rem_budget -= len(level_i_indices)
-                else:
-                    activate_indices = np.random.choice(level_i_indices, rem_budget, replace=False)
-                    actions[activate_indices] = 1
-                    rem_budget = 0
-                    break
+            good_arm_mask = (cur_states == self.virtual_states).astype(np.int8)
+            tb_ranks = get_priority_ranks(self.sspa_size, tb_param)
+            priority_levels = self.goodness_levels[2 * good_arm_mask + virtual_actions] * (len(tb_param) + 1) \
+                              + tb_ranks[self.virtual_states]
+            actions = select_top_k(- (priority_levels + self._rng.random(self.N)), budget)
         else:
             raise NotImplementedError
 
@@ -545,21 +507,9 @@ class FTVAPolicy(object):
 
     def virtual_step(self, prev_states, cur_states, actions, virtual_actions):
         # simulation with coupling
-        agree_mask = np.all([prev_states == self.virtual_states, actions == virtual_actions], axis=0)
-        agree_indices = np.where(agree_mask)[0]
-        # for those arms whose virtual state-action pairs agree with real ones (good arms), couple the next states
-        self.virtual_states[agree_indices] = cur_states[agree_indices]
-
-        sa2indices = {sa_pair:[] for sa_pair in self.sa_pairs}
-        for sa_pair in self.sa_pairs:
-            # find out the indices of the bad arms whose (virtual state, action) = sa_pair
-            sa2indices[sa_pair] = np.where(np.all([self.virtual_states == sa_pair[0],
-                                                   virtual_actions == sa_pair[1],
-                                                   1 - agree_mask], axis=0))[0]
-        for sa_pair in self.sa_pairs:
-            cur_indices = sa2indices[sa_pair[0], sa_pair[1]]
-            self.virtual_states[cur_indices] = np.random.choice(self.sspa, size=len(cur_indices),
-                                                                p=self.trans_tensor[sa_pair[0], sa_pair[1]])
+        u = self._rng.random(self.N)
+        coupled_step(prev_states, cur_states, actions, self.virtual_states, virtual_actions, self.flat_cum_trans, u,
+                     out=self.virtual_states)
 
     def get_virtual_states(self):
         return self.virtual_states.copy()
@@ -580,14 +530,156 @@ def sa_list_to_freq(sspa_size, states, actions):
         sa_pair_freq[s,a] += 1
     return sa_pair_freq / len(states)
 
+def make_rng(seed=None):
+    """
+    :param seed: the seed of the generator. If not provided, it is drawn from the global state of np.random,
+        so that np.random.seed still makes the simulations reproducible
+    :return: a np.random.Generator
+    """
+    if seed is None:
+        seed = np.random.randint(0, 2**32, dtype=np.int64)
+    return np.random.default_rng(seed)
+
+def randomized_rounding(x, rng):
+    """
+    round x up or down at random, such that the expectation of the result is x
+    :param x: a non-negative number
+    :param rng: a np.random.Generator
+    :return: the integer floor(x) + 1 with probability x - floor(x), and floor(x) otherwise
+    """
+    floor_x = int(x)
+    return floor_x + int(rng.random() < x - floor_x)
+
+def get_state_dtype(sspa_size):
+    """
+    :param sspa_size: the size of the state space S
+    :return: the smallest signed integer dtype that can hold the states 0, 1, ..., S-1
+    """
+    for dtype in [np.int8, np.int16, np.int32]:
+        if sspa_size - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def get_priority_ranks(sspa_size, priority_list):
+    """
+    :param sspa_size: the size of the state space S
+    :param priority_list: a list of states, from high priority to low priority
+    :return: a length-S array of the rank of each state in the priority list, where 0 is the highest priority;
+        states not in the list are ranked last
+    """
+    ranks = np.full((sspa_size,), len(priority_list), dtype=np.intp)
+    ranks[np.asarray(priority_list, dtype=np.intp)] = np.arange(len(priority_list))
+    return ranks
+
+def group_by_state(states, sspa_size):
+    """
+    group the arms by their states using one sort, instead of scanning all the arms once for each state
+    :param states: the states of the arms, which is a length-N array
+    :param sspa_size: the size of the state space S
+    :return: (order, boundaries); the indices of the arms in state s are order[boundaries[s]:boundaries[s+1]]
+    """
+    order = np.argsort(states, kind="stable")
+    boundaries = np.searchsorted(states[order], np.arange(sspa_size + 1))
+    return order, boundaries
+
+def select_top_k(scores, k):
+    """
+    activate the k arms with the largest scores, using a partial sort instead of a full sort
+    :param scores: a length-N array of scores of the arms
+    :param k: the number of arms to activate, between 0 and N
+    :return: a length-N array of actions, where the k arms with the largest scores take action 1
+    """
+    actions = np.zeros((len(scores),), dtype=np.int8)
+    if k > 0:
+        actions[np.argpartition(-scores, k - 1)[:k]] = 1
+    return actions
+
+def sample_next_states(states, actions, flat_cum_trans, u, out=None):
+    """
+    sample the next states of the arms by inverting the cumulative transition probabilities
+    :param states: integer array of length N, the current states of the arms
+    :param actions: integer array of length N, the actions of the arms
+    :param flat_cum_trans: np array of shape (S*A,S), the cumulative sum of the transition kernel along the last axis,
+        where the row of (state, action) is state * A + action
+    :param u: array of length N, uniform random numbers in [0,1), one for each arm
+    :param out: optional integer array of length N to write the next states into; it can be the states array itself
+    :return: the next states of the arms
+    """
+    sspa_size = flat_cum_trans.shape[1]
+    aspa_size = flat_cum_trans.shape[0] // sspa_size
+    if out is None:
+        out = np.empty_like(states)
+    if numba is not None:
+        _sample_next_states_jit(states, actions, flat_cum_trans, aspa_size, u, out)
+    else:
+        # the clipping guards against round-off in flat_cum_trans[:, -1]
+        cum_rows = flat_cum_trans[states.astype(np.intp) * aspa_size + actions]
+        out[:] = np.minimum(np.sum(u[:, None] >= cum_rows, axis=1), sspa_size - 1)
+    return out
+
+def coupled_step(prev_states, cur_states, actions, virtual_states, virtual_actions, flat_cum_trans, u, out=None):
+    """
+    the coupled transition of the virtual states in one pass over the arms:
+    for the arms whose virtual state-action pairs agree with the real ones (good arms), the next virtual state is the
+    next real state; for the other arms (bad arms), the next virtual state is sampled independently
+    :param prev_states: integer array of length N, the real states of the arms before the transition
+    :param cur_states: integer array of length N, the real states of the arms after the transition
+    :param actions: integer array of length N, the real actions of the arms
+    :param virtual_states: integer array of length N, the virtual states of the arms before the transition
+    :param virtual_actions: integer array of length N, the virtual actions of the arms
+    :param flat_cum_trans: np array of shape (S*A,S), the cumulative sum of the transition kernel along the last axis,
+        where the row of (state, action) is state * A + action
+    :param u: array of length N, uniform random numbers in [0,1), one for each arm
+    :param out: optional integer array of length N to write the next virtual states into; it can be virtual_states itself
+    :return: the next virtual states of the arms
+    """
+    if out is None:
+        out = np.empty_like(virtual_states)
+    if numba is not None:
+        aspa_size = flat_cum_trans.shape[0] // flat_cum_trans.shape[1]
+        _coupled_step_jit(prev_states, cur_states, actions, virtual_states, virtual_actions, flat_cum_trans, aspa_size, u, out)
+    else:
+        agree_mask = np.logical_and(prev_states == virtual_states, actions == virtual_actions)
+        sampled_states = sample_next_states(virtual_states, virtual_actions, flat_cum_trans, u)
+        out[:] = np.where(agree_mask, cur_states, sampled_states)
+    return out
+
+if numba is not None:
+    @numba.njit(inline="always")
+    def _search_cum_row(cum_row, u_i):
+        # binary search for the first entry of the cumulative row that exceeds u_i;
+        # the search never goes beyond the last state, which guards against round-off in cum_row[-1]
+        low = 0
+        high = len(cum_row) - 1
+        while low < high:
+            mid = (low + high) // 2
+            if cum_row[mid] > u_i:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    @numba.njit(parallel=True, cache=True)
+    def _sample_next_states_jit(states, actions, flat_cum_trans, aspa_size, u, out):
+        for i in numba.prange(len(states)):
+            out[i] = _search_cum_row(flat_cum_trans[np.intp(states[i]) * aspa_size + actions[i]], u[i])
+
+    @numba.njit(parallel=True, cache=True)
+    def _coupled_step_jit(prev_states, cur_states, actions, virtual_states, virtual_actions, flat_cum_trans, aspa_size, u, out):
+        for i in numba.prange(len(virtual_states)):
+            if (prev_states[i] == virtual_states[i]) and (actions[i] == virtual_actions[i]):
+                out[i] = cur_states[i]
+            else:
+                out[i] = _search_cum_row(flat_cum_trans[np.intp(virtual_states[i]) * aspa_size + virtual_actions[i]], u[i])
+
 def states_from_state_fracs(sspa_size, N, state_fracs):
     """
     :param sspa_size: the size of the state space
     :param N: the number of arms
     :param state_fracs: the state frequency
-    :return: a length-N array of states, such that the ratio of each state is given by state_fracs
+    :return: a length-N integer array of states, such that the ratio of each state is given by state_fracs
     """
-    states = np.zeros((N,))
+    states = np.zeros((N,), dtype=get_state_dtype(sspa_size))
     for s in range(sspa_size):
         start_ind = int(N * np.sum(state_fracs[0:s]))
         end_ind = int(N * np.sum(state_fracs[0:(s+1)]))
@@ -2,6 +2,7 @@ import unittest
 import rb_settings
 from discrete_RB import *
 from experiments import test_local_stability
+from experiments import RandomTBPolicy_experiment_one_point
 
 
 class TestDiscreteRB(unittest.TestCase):
@@ -60,6 +61,18 @@ class TestDiscreteRB(unittest.TestCase):
             # WIP and LP-priority are the same on the three examples in Gast et.al. 2020
             print("WIP and LP-priority are the same on Example {}".format(i))
 
+    def test_whittle_rvi_agrees_with_lp(self):
+        """
+        solving the relaxed problems by relative value iteration should give the same Whittle's index policy as the LP
+        """
+        for i, setting in enumerate([rb_settings.Gast20Example1(), rb_settings.Gast20Example2(), rb_settings.Gast20Example3()]):
+            analyzer = SingleArmAnalyzer(setting.sspa_size, setting.trans_tensor, setting.reward_tensor, act_frac=0.4)
+            rvi_priority_list, rvi_indexable = analyzer.solve_whittles_policy(method="rvi")
+            lp_priority_list, lp_indexable = analyzer.solve_whittles_policy(method="lp")
+            self.assertEqual(rvi_priority_list, lp_priority_list)
+            self.assertEqual(rvi_indexable, lp_indexable)
+        with self.assertRaises(ValueError):
+            analyzer.solve_whittles_policy(method="unknown")
 
     def test_sanity_of_solving_q_function(self):
         """
@@ -80,6 +93,100 @@ class TestDiscreteRB(unittest.TestCase):
             self.assertTrue(np.all((action_gap < - 1e-4)==fluid_passive),
                             msg="action_gap\n {} \n, y=\n {}".format(action_gap, analyzer.y.value))
 
+    def test_rb_step_transition_fracs(self):
+        """
+        the empirical next-state fractions and the reward of RB.step should match the transition kernel
+        """
+        setting = rb_settings.Gast20Example1()
+        N = 100000
+        for state in range(setting.sspa_size):
+            for action in range(2):
+                rb = RB(setting.sspa_size, setting.trans_tensor, setting.reward_tensor, N,
+                        init_states=state * np.ones((N,), dtype=np.int64))
+                instant_reward = rb.step(action * np.ones((N,), dtype=np.int64))
+                self.assertAlmostEqual(instant_reward, setting.reward_tensor[state, action])
+                self.assertTrue(np.allclose(rb.get_s_fracs(), setting.trans_tensor[state, action, :], atol=1e-2),
+                                msg="{} != {}".format(rb.get_s_fracs(), setting.trans_tensor[state, action, :]))
+
+    def test_priority_policy_actions(self):
+        """
+        the priority policy should use up the budget, and only break ties in the lowest-priority state it activates
+        """
+        cur_states = np.array([0, 0, 0, 1, 1, 1, 2, 2, 2, 2])
+        policy = PriorityPolicy(3, [2, 0, 1], N=10, act_frac=0.5)
+        for t in range(100):
+            actions = policy.get_actions(cur_states)
+            self.assertEqual(np.sum(actions), 5)
+            self.assertTrue(np.all(actions[cur_states == 2] == 1))
+            self.assertTrue(np.all(actions[cur_states == 1] == 0))
+            self.assertEqual(np.sum(actions[cur_states == 0]), 1)
+
+    def test_coupled_step(self):
+        """
+        good arms should follow their real states, and bad arms should transition according to the virtual actions
+        """
+        setting = rb_settings.Gast20Example1()
+        flat_cum_trans = np.cumsum(setting.trans_tensor.reshape((setting.sspa_size * 2, setting.sspa_size)), axis=1)
+        N = 100000
+        prev_states = np.zeros((N,), dtype=np.int8)
+        cur_states = 2 * np.ones((N,), dtype=np.int8)
+        actions = np.ones((N,), dtype=np.int8)
+        virtual_states = np.zeros((N,), dtype=np.int8)
+        virtual_actions = np.ones((N,), dtype=np.int8)
+        virtual_actions[N//2:] = 0  # the second half are bad arms
+        u = np.random.uniform(0, 1, size=N)
+        next_virtual_states = coupled_step(prev_states, cur_states, actions, virtual_states, virtual_actions, flat_cum_trans, u)
+        self.assertTrue(np.all(next_virtual_states[:N//2] == 2))
+        bad_fracs = np.bincount(next_virtual_states[N//2:], minlength=setting.sspa_size) / (N - N//2)
+        self.assertTrue(np.allclose(bad_fracs, setting.trans_tensor[0, 0, :], atol=1e-2),
+                        msg="{} != {}".format(bad_fracs, setting.trans_tensor[0, 0, :]))
+
+    def test_seeded_simulation_is_reproducible(self):
+        """
+        the simulation with FTVA should give the same trajectory when the RB and the policy are given the same seeds
+        """
+        setting = rb_settings.Gast20Example2()
+        analyzer = SingleArmAnalyzer(setting.sspa_size, setting.trans_tensor, setting.reward_tensor, act_frac=0.4)
+        opt_value, y = analyzer.solve_lp()
+        N = 1000
+        rewards = []
+        for run in range(2):
+            rb = RB(setting.sspa_size, setting.trans_tensor, setting.reward_tensor, N, seed=0)
+            policy = FTVAPolicy(setting.sspa_size, setting.trans_tensor, setting.reward_tensor, y=y, N=N, act_frac=0.4,
+                                init_virtual=None, seed=1)
+            cur_rewards = []
+            for t in range(50):
+                prev_states = rb.get_states()
+                actions, virtual_actions = policy.get_actions(prev_states)
+                cur_rewards.append(rb.step(actions))
+                policy.virtual_step(prev_states, rb.get_states(), actions, virtual_actions)
+            rewards.append(cur_rewards)
+        self.assertEqual(rewards[0], rewards[1])
+
+    def test_global_seed_makes_experiment_reproducible(self):
+        """
+        np.random.seed should still make the experiments reproducible, without passing seeds to the simulation objects
+        """
+        setting = rb_settings.Gast20Example2()
+        analyzer = SingleArmAnalyzer(setting.sspa_size, setting.trans_tensor, setting.reward_tensor, act_frac=0.4)
+        opt_value, y = analyzer.solve_lp()
+        avg_rewards = []
+        for run in range(2):
+            np.random.seed(0)
+            avg_rewards.append(RandomTBPolicy_experiment_one_point(100, 50, 0.4, setting, y))
+        self.assertEqual(avg_rewards[0], avg_rewards[1])
+
+    def test_policies_accept_states_from_state_fracs(self):
+        """
+        the states built by states_from_state_fracs should be valid inputs of the policies
+        """
+        cur_states = states_from_state_fracs(3, 10, np.array([0.3, 0.3, 0.4]))
+        self.assertTrue(np.issubdtype(cur_states.dtype, np.integer))
+        y = np.array([[0.1, 0.2], [0.2, 0.1], [0.3, 0.1]])
+        actions = PriorityPolicy(3, [2, 0, 1], N=10, act_frac=0.4).get_actions(cur_states)
+        self.assertEqual(np.sum(actions), 4)
+        actions = RandomTBPolicy(3, y, N=10, act_frac=0.4).get_actions(cur_states)
+        self.assertEqual(np.sum(actions), 4)
 
 
 if __name__ == '__main__':